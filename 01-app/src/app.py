@@ -1,31 +1,43 @@
 # Standard library imports
 import os
+import asyncio
+import html
 import logging
+import re
+import time
 import datetime
 import threading
 from datetime import timedelta
 from typing import Optional, List, Dict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-import uuid
-import json
-import requests
+import secrets
+from collections import deque
+from urllib.parse import urlencode
 
 # Third-party imports
+import httpx
+import orjson
 import uvicorn
 import telebot
 from telebot import types
-from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
 # Google Cloud imports
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import firestore
 import google.generativeai as genai
 
 from templates import (
     START_TEXT,
-    SYSTEM_INSTRUCTIONS,
-    HEALTH_REPORT_PROMPT,
+    CHAT_PERSONA,
+    PROACTIVE_PERSONA,
+    render_chat_context,
+    render_proactive_context,
+    render_health_report,
 )
 
 load_dotenv()
@@ -44,17 +56,80 @@ GEMINI_MODEL_NAME = os.environ.get("GEMINI_MODEL_NAME")
 logging.basicConfig(level=logging.INFO)
 genai.configure(api_key=os.environ["GEMINI_API_KEY"])
 
+# Static part of the WHOOP OAuth URL, built (and URL-encoded) once; only the
+# per-user state is appended at request time
+WHOOP_AUTH_URL_PREFIX = (
+    "https://api.prod.whoop.com/oauth/oauth2/auth?"
+    + urlencode({
+        "response_type": "code",
+        "client_id": WHOOP_CLIENT_ID or "",
+        "redirect_uri": f"{URL}/whoop/callback",
+        "scope": "offline read:profile read:recovery read:sleep read:workout",
+    })
+)
+
 
 # (2) STARTUP & GLOBAL OBJECTS
 
+def _log_bulk_write_error(error, writer) -> bool:
+    """BulkWriter error callback: log the failure, retry a couple of times."""
+    logging.error(f"Buffered Firestore write failed: {error.message}")
+    return error.attempts < 3
+
+
+async def process_updates():
+    """Drain queued webhook updates and dispatch them to the bot handlers."""
+    while True:
+        update = await update_queue.get()
+        try:
+            await asyncio.to_thread(bot.process_new_updates, [update])
+        except Exception as e:
+            logging.error(f"Error processing update: {e}")
+        finally:
+            update_queue.task_done()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global db, model
+    global db, adb, bulk_writer, model, chat_model, proactive_model, \
+        whoop_client, update_queue
 
+    update_workers = []
+    flush_task = None
+    poll_task = None
     try:
+        # Bounded queue + worker set for webhook updates: the endpoint just
+        # enqueues and acks, these workers do the actual dispatch. A full
+        # queue gives explicit back-pressure instead of webhook timeouts.
+        update_queue = asyncio.Queue(maxsize=1024)
+        update_workers = [asyncio.create_task(process_updates()) for _ in range(4)]
+
+        # Shared async HTTP client so WHOOP calls reuse pooled keep-alive
+        # connections instead of paying a TLS handshake per request
+        whoop_client = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(max_keepalive_connections=50),
+        )
+
         # Initialize Firestore and Vertex AI as before
         db = firestore.Client(project=GCP_PROJECT_ID)
-        logging.info("Firestore client initialized")
+        # Async client for endpoints that run on the event loop and would
+        # otherwise block it on Firestore round-trips
+        adb = firestore.AsyncClient(project=GCP_PROJECT_ID)
+        logging.info("Firestore clients initialized")
+
+        # Shared BulkWriter so fire-and-forget writes (proactive messages,
+        # single-message stores) coalesce into batched commits instead of
+        # paying one RPC each
+        bulk_writer = db.bulk_writer()
+        bulk_writer.on_write_error(_log_bulk_write_error)
+
+        async def flush_bulk_writer():
+            while True:
+                await asyncio.sleep(0.25)
+                await asyncio.to_thread(bulk_writer.flush)
+
+        flush_task = asyncio.create_task(flush_bulk_writer())
 
         generation_config = {
             "max_output_tokens": 65536,
@@ -66,12 +141,60 @@ async def lifespan(app: FastAPI):
             generation_config=generation_config,
         )
         logging.info("Vertex AI model initialized")
-        
+
+        # Chat variant with the static persona as system instruction: the
+        # persona stays byte-identical across turns and users, so Gemini's
+        # prefix cache can reuse it; only the per-turn context diverges.
+        chat_model = genai.GenerativeModel(
+            model_name=GEMINI_MODEL_NAME,
+            generation_config=generation_config,
+            system_instruction=CHAT_PERSONA,
+        )
+
+        # Proactive variant likewise carries its persona as a static system
+        # instruction. The persona is a few hundred tokens — far below the
+        # explicit CachedContent minimum, so server-side caching doesn't
+        # apply here; the byte-identical prefix still gets implicit reuse.
+        proactive_model = genai.GenerativeModel(
+            model_name=GEMINI_MODEL_NAME,
+            generation_config=generation_config,
+            system_instruction=PROACTIVE_PERSONA,
+        )
+
+        # Warm the gRPC channels and auth token caches so the first real user
+        # message doesn't pay connection setup + token mint latency
+        try:
+            model.generate_content("ping", generation_config={"max_output_tokens": 1})
+            logging.info("Gemini channel warmed")
+        except Exception as e:
+            logging.warning(f"Gemini warm-up call failed: {e}")
+        try:
+            # Any read forces channel setup + database metadata fetch
+            db.collection("users").limit(1).get()
+            logging.info("Firestore channel warmed")
+        except Exception as e:
+            logging.warning(f"Firestore warm-up read failed: {e}")
+
+
         # Only set up new webhook if we're in webhook mode
         if BOT_MODE == "webhook":
             webhook_url = f"{URL}/webhook"
-            bot.set_webhook(url=webhook_url)
+            # Raise the delivery cap above the default 40 so bursts fan out
+            # instead of queueing on Telegram's side, and only subscribe to
+            # the update types we actually handle
+            bot.set_webhook(
+                url=webhook_url,
+                max_connections=100,
+                allowed_updates=["message"],
+            )
             logging.info(f"Telegram webhook set to: {webhook_url}")
+        elif BOT_MODE == "polling":
+            # Fold the poller into the app's own loop instead of a separate
+            # thread scheduler: the to_thread hop only occupies a pool thread
+            # during the blocking long-poll HTTP call
+            bot.remove_webhook()
+            poll_task = asyncio.create_task(asyncio.to_thread(bot.infinity_polling))
+            logging.info("Started bot polling")
 
     except Exception as e:
         logging.error(f"Error during initialization: {e}")
@@ -80,12 +203,33 @@ async def lifespan(app: FastAPI):
     yield
 
     logging.info("Shutting down...")
-
-
-app = FastAPI(lifespan=lifespan)
-bot = telebot.TeleBot(TELEGRAM_TOKEN, parse_mode="HTML")
+    for worker in update_workers:
+        worker.cancel()
+    if flush_task is not None:
+        flush_task.cancel()
+        # Drain anything still buffered before the process exits
+        await asyncio.to_thread(bulk_writer.flush)
+    if poll_task is not None:
+        bot.stop_polling()
+        await poll_task
+    await whoop_client.aclose()
+
+
+# orjson also serializes the (small) endpoint responses
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+# No default parse_mode: most replies (errors, prompts, streamed partials)
+# are plain text, so they skip Telegram-side HTML validation; the few
+# HTML-formatted sends pass parse_mode="HTML" explicitly.
+# threaded=False: handlers run directly on the lifespan's worker set, which
+# is the real bounded execution pool — telebot's default internal pool
+# would accept updates into an unbounded queue (defeating the queue's
+# back-pressure) and run at most two handlers at a time.
+bot = telebot.TeleBot(TELEGRAM_TOKEN, threaded=False)
 logging.info("Telegram bot initialized")
 
+# Small pool for overlapping independent blocking I/O inside sync handlers
+_io_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="io")
+
 
 # (3) FIRESTORE DATA MODEL & INTERACTIONS
 
@@ -94,67 +238,268 @@ class UserProfile(BaseModel):
     name: Optional[str] = None
     joined_at: Optional[datetime.datetime] = None
 
+# Telegram ids already known to have a profile, so warm /start calls
+# skip Firestore entirely
+_known_users = set()
+
+# In-process cache of recent chat history per user. The bot itself writes
+# every message, so appending on write keeps a hot conversation served
+# entirely from memory within the TTL.
+_history_cache: Dict[str, dict] = {}
+_history_cache_lock = threading.Lock()
+_HISTORY_CACHE_TTL = 3600  # seconds
+_HISTORY_CACHE_MAXLEN = 200
+
+def _history_cache_get(telegram_id: str, limit: int) -> Optional[list]:
+    with _history_cache_lock:
+        entry = _history_cache.get(telegram_id)
+        if not entry or time.monotonic() - entry["cached_at"] > _HISTORY_CACHE_TTL:
+            _history_cache.pop(telegram_id, None)
+            return None
+        # An entry filled by a shallower read (e.g. the check-in's limit=5)
+        # may be missing older messages a deeper request needs, so treat
+        # asking for more than was fetched as a miss
+        if limit > entry["fill_limit"]:
+            return None
+        return list(entry["messages"])[-limit:]
+
+def _history_cache_put(telegram_id: str, messages: list, fill_limit: int) -> None:
+    with _history_cache_lock:
+        _history_cache[telegram_id] = {
+            "cached_at": time.monotonic(),
+            "fill_limit": fill_limit,
+            "messages": deque(messages, maxlen=_HISTORY_CACHE_MAXLEN),
+        }
+
+def _history_cache_append(telegram_id: str, role: str, content: str) -> None:
+    with _history_cache_lock:
+        entry = _history_cache.get(telegram_id)
+        if entry:
+            entry["messages"].append({
+                "role": role,
+                "content": content,
+                "timestamp": datetime.datetime.now(datetime.timezone.utc),
+            })
+            entry["cached_at"] = time.monotonic()
+
+# Short-TTL cache of user profile documents so hot users don't pay a
+# Firestore read on every interaction
+_user_cache: Dict[str, tuple] = {}
+_user_cache_lock = threading.Lock()
+_USER_CACHE_TTL = 60  # seconds
+
+def get_user_data(telegram_id: str) -> Optional[dict]:
+    """Fetch a user document with a short in-process cache. None = no profile."""
+    with _user_cache_lock:
+        entry = _user_cache.get(telegram_id)
+        if entry and time.monotonic() - entry[1] < _USER_CACHE_TTL:
+            return entry[0]
+
+    snapshot = db.collection("users").document(telegram_id).get()
+    user_data = snapshot.to_dict() if snapshot.exists else None
+    with _user_cache_lock:
+        _user_cache[telegram_id] = (user_data, time.monotonic())
+    return user_data
+
+def invalidate_user_cache(telegram_id: str) -> None:
+    with _user_cache_lock:
+        _user_cache.pop(telegram_id, None)
+
+def ensure_user_profile(telegram_id: str, name: Optional[str]) -> None:
+    """Create the user profile if it doesn't exist, without a read-before-write."""
+    if telegram_id in _known_users:
+        return
+    try:
+        db.collection("users").document(telegram_id).create({
+            "telegram_id": telegram_id,
+            "name": name,
+            "joined_at": datetime.datetime.utcnow()
+        })
+    except AlreadyExists:
+        pass
+    else:
+        # The cache may hold a stale "no profile" entry
+        invalidate_user_cache(telegram_id)
+    _known_users.add(telegram_id)
+
 def store_chat_message(telegram_id: str, role: str, content: str) -> None:
     """Store a chat message in Firestore using the new data structure."""
     try:
-        # Generate a unique message ID (you could also use Firestore's auto-ID)
-        message_id = str(uuid.uuid4())
-        
-        # Create the chat document in the chats subcollection
-        db.collection("users").document(telegram_id)\
-          .collection("chats").document(message_id).set({
-            "timestamp": datetime.datetime.utcnow(),
+        # Enqueue the write on the shared BulkWriter instead of paying a
+        # round-trip per message: concurrent writes coalesce into batched
+        # commits and the periodic flush loop bounds how long one can sit
+        # in a partially filled batch. The server assigns the timestamp so
+        # ordering is immune to client clock skew.
+        user_ref = db.collection("users").document(telegram_id)
+        bulk_writer.create(user_ref.collection("chats").document(), {
+            "timestamp": firestore.SERVER_TIMESTAMP,
             "content": content,
             "role": "user" if role == "user" else "assistant"
         })
+        # Keep the profile-level activity marker current so the scheduled
+        # check-in can skip fresh conversations without reading their history
+        bulk_writer.set(user_ref, {"last_message_at": firestore.SERVER_TIMESTAMP},
+                        merge=True)
+        _history_cache_append(telegram_id, "user" if role == "user" else "assistant", content)
     except Exception as e:
         logging.error(f"Error storing chat message for user {telegram_id}: {e}")
         raise
 
-def get_chat_history(telegram_id: str, limit: int = 100) -> list:
+def store_chat_turn(telegram_id: str, user_content: str, assistant_content: str) -> None:
+    """Store a user/assistant message pair in one batched commit (single RPC)."""
+    try:
+        chats_ref = db.collection("users").document(telegram_id).collection("chats")
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        batch = db.batch()
+        batch.set(chats_ref.document(), {
+            "timestamp": now,
+            "content": user_content,
+            "role": "user",
+        })
+        # Nudge the assistant timestamp so ordering stays deterministic
+        batch.set(chats_ref.document(), {
+            "timestamp": now + timedelta(microseconds=1),
+            "content": assistant_content,
+            "role": "assistant",
+        })
+        # Profile-level activity marker consumed by the scheduled check-in
+        batch.set(db.collection("users").document(telegram_id),
+                  {"last_message_at": now + timedelta(microseconds=1)},
+                  merge=True)
+        batch.commit()
+        _history_cache_append(telegram_id, "user", user_content)
+        _history_cache_append(telegram_id, "assistant", assistant_content)
+    except Exception as e:
+        logging.error(f"Error storing chat turn for user {telegram_id}: {e}")
+        raise
+
+def get_chat_history(telegram_id: str, limit: int = 20) -> list:
     """Retrieve recent chat history from the new data structure."""
-    print(f"GETTING CHAT HISTORY FOR {telegram_id}")
+    logging.debug("Getting chat history for %s", telegram_id)
+    # Serve hot conversations from the in-process cache
+    cached = _history_cache_get(telegram_id, limit)
+    if cached is not None:
+        return cached
+
     try:
-        # Query the chats subcollection, ordered by timestamp
+        # Query the newest messages first so the limit keeps the recent
+        # tail of the conversation instead of its oldest entries
         chats_ref = db.collection("users").document(telegram_id)\
                      .collection("chats")\
-                     .order_by("timestamp", direction=firestore.Query.ASCENDING)\
+                     .order_by("timestamp", direction=firestore.Query.DESCENDING)\
                      .limit(limit)
-        
+
         # Get the documents and convert to the format expected by the bot
         messages = []
         for chat in chats_ref.stream():
             chat_data = chat.to_dict()
+            # Keep the native (timezone-aware) datetime: consumers do date
+            # arithmetic on it, so stringifying here would just force them
+            # to parse it back
             messages.append({
                 "role": chat_data["role"],
                 "content": chat_data["content"],
-                "timestamp": chat_data["timestamp"].isoformat()
+                "timestamp": chat_data["timestamp"]
             })
-        
-        # Remove the reversal to keep chronological order (oldest first)
+
+        # Reverse back to chronological order (oldest first)
+        messages.reverse()
+        _history_cache_put(telegram_id, messages, limit)
         return messages
     except Exception as e:
         logging.error(f"Error retrieving chat history for user {telegram_id}: {e}")
         return []
 
+# Daily health metrics only change when the hourly WHOOP sync writes them,
+# yet every chat turn re-reads the day's doc. A short TTL keeps hot users
+# from paying that read per message while staying well inside the sync cadence.
+_health_cache: Dict[tuple, tuple] = {}
+_health_cache_lock = threading.Lock()
+_HEALTH_CACHE_TTL = 300  # seconds
+
+def invalidate_health_cache(telegram_id: str, date_str: str) -> None:
+    with _health_cache_lock:
+        _health_cache.pop((telegram_id, date_str), None)
+
 def get_daily_health_data_from_firestore(telegram_id: str, date_str: str) -> dict:
     """
-    Fetch daily health_metrics doc for the given user & date 
+    Fetch daily health_metrics doc for the given user & date
     from Firestore and return it.
     """
+    with _health_cache_lock:
+        entry = _health_cache.get((telegram_id, date_str))
+        if entry and time.monotonic() - entry[1] < _HEALTH_CACHE_TTL:
+            return entry[0]
+
     doc_ref = (
         db.collection("users")
           .document(telegram_id)
           .collection("health_metrics")
           .document(date_str)
     )
-    print(f"DATE: {date_str}")
+    logging.debug("Fetching health metrics for %s", date_str)
     doc_snapshot = doc_ref.get()
 
-    if not doc_snapshot.exists:
-        return {}
+    daily_data = doc_snapshot.to_dict() if doc_snapshot.exists else {}
+    with _health_cache_lock:
+        _health_cache[(telegram_id, date_str)] = (daily_data, time.monotonic())
+    return daily_data
 
-    return doc_snapshot.to_dict()
+def prefetch_recent_chat_histories(per_user_limit: int = 20,
+                                   max_docs: int = 10000) -> None:
+    """
+    Warm the history cache for every user with one collection-group query
+    over the newest chat messages, replacing the N per-user history streams
+    the scheduled check-in would otherwise issue.
+    """
+    query = db.collection_group("chats") \
+              .order_by("timestamp", direction=firestore.Query.DESCENDING) \
+              .limit(max_docs)
+
+    by_user: Dict[str, list] = {}
+    doc_count = 0
+    for doc in query.stream():
+        doc_count += 1
+        # Path is users/{telegram_id}/chats/{auto_id}
+        telegram_id = doc.reference.parent.parent.id
+        bucket = by_user.setdefault(telegram_id, [])
+        if len(bucket) < per_user_limit:
+            chat_data = doc.to_dict()
+            bucket.append({
+                "role": chat_data["role"],
+                "content": chat_data["content"],
+                "timestamp": chat_data["timestamp"]
+            })
+
+    # If the query ran into the max_docs horizon, a short bucket may just
+    # mean the user's older messages fell outside the window, not that this
+    # is their whole history — only cache buckets that are provably complete
+    horizon_hit = doc_count >= max_docs
+    cached = 0
+    for telegram_id, messages in by_user.items():
+        if horizon_hit and len(messages) < per_user_limit:
+            continue
+        # Buckets were filled newest-first; flip to chronological order
+        messages.reverse()
+        _history_cache_put(telegram_id, messages, per_user_limit)
+        cached += 1
+    logging.info(f"Prefetched chat history for {cached} of {len(by_user)} users")
+
+def get_daily_health_data_for_all_users(date_str: str) -> Dict[str, dict]:
+    """
+    Fetch the given day's health_metrics docs for every user with a single
+    collection-group query, keyed by telegram_id. Replaces the N+1 per-user
+    reads in the scheduled check-in.
+    """
+    day_start = datetime.datetime.strptime(date_str, "%Y-%m-%d")
+    results = {}
+    query = db.collection_group("health_metrics") \
+              .where("timestamp", ">=", day_start)
+    for doc in query.stream():
+        # Path is users/{telegram_id}/health_metrics/{date_str}
+        results[doc.reference.parent.parent.id] = doc.to_dict()
+    return results
 
 
 # (4) TELEGRAM BOT HANDLERS
@@ -165,15 +510,10 @@ def handle_start(message: types.Message):
     telegram_id = str(message.from_user.id)
     
     try:
-        # Create user profile document if it doesn't exist
-        user_doc_ref = db.collection("users").document(telegram_id)
-        if not user_doc_ref.get().exists:
-            user_doc_ref.set({
-                "telegram_id": telegram_id,
-                "name": message.from_user.first_name,
-                "joined_at": datetime.datetime.utcnow()
-            })
-        
+        # Create user profile document if it doesn't exist (single write RPC,
+        # no read-before-write)
+        ensure_user_profile(telegram_id, message.from_user.first_name)
+
         bot.reply_to(message, START_TEXT)
          
     except Exception as e:
@@ -185,17 +525,7 @@ def handle_link_whoop(message: types.Message):
     """Handle /linkwhoop command to connect WHOOP account."""
     telegram_id = str(message.from_user.id)
     state_value = create_oauth_state_for_user(telegram_id)
-    redirect_uri = f"{URL}/whoop/callback"
-    scope = "offline read:profile read:recovery read:sleep read:workout"
-    
-    auth_url = (
-        "https://api.prod.whoop.com/oauth/oauth2/auth"
-        f"?response_type=code"
-        f"&client_id={WHOOP_CLIENT_ID}"
-        f"&redirect_uri={redirect_uri}"
-        f"&scope={scope}"
-        f"&state={state_value}"
-    )
+    auth_url = f"{WHOOP_AUTH_URL_PREFIX}&state={state_value}"
 
     bot.reply_to(
         message,
@@ -204,6 +534,7 @@ def handle_link_whoop(message: types.Message):
             f'<a href="{auth_url}">Authorize Bot</a>\n\n'
             "After you approve access, you'll be redirected back, and I'll store your tokens."
         ),
+        parse_mode="HTML",
     )
 
 @bot.message_handler(commands=["report"])
@@ -214,9 +545,8 @@ def handle_report(message: types.Message):
     """
     telegram_id = str(message.from_user.id)
 
-    # Check if user exists
-    user_doc_ref = db.collection("users").document(telegram_id).get()
-    if not user_doc_ref.exists:
+    # Check if user exists (cached lookup)
+    if get_user_data(telegram_id) is None:
         bot.reply_to(message, "Please /start first.")
         return
 
@@ -285,6 +615,10 @@ def handle_report(message: types.Message):
         f"<b>Workout</b>\n{workout_summary_text}\n"
     )
 
+    # Send the data summary right away — the user shouldn't sit through the
+    # Gemini round-trip before seeing their own numbers
+    bot.reply_to(message, report_text, parse_mode="HTML")
+
     #
     # 3) Generate a short LLM analysis based on **full** data (all raw JSON).
     #    That way, the analysis can see everything, not just the limited summary.
@@ -292,12 +626,13 @@ def handle_report(message: types.Message):
     # We'll pass the entire raw records to Gemini so it can see details of each record.
     #
 
-    # Convert each category's data to JSON strings
-    sleep_json = json.dumps(sleep_records, indent=2)
-    recovery_json = json.dumps(recovery_records, indent=2)
-    workout_json = json.dumps(workout_records, indent=2)
+    # Convert each category's data to compact JSON — pretty-printing only
+    # bloats the prompt (and the Gemini input-token bill)
+    sleep_json = orjson.dumps(sleep_records, default=str).decode()
+    recovery_json = orjson.dumps(recovery_records, default=str).decode()
+    workout_json = orjson.dumps(workout_records, default=str).decode()
 
-    analysis_prompt = HEALTH_REPORT_PROMPT.format(
+    analysis_prompt = render_health_report(
         date_str=date_str,
         sleep_json=sleep_json,
         recovery_json=recovery_json,
@@ -312,20 +647,25 @@ def handle_report(message: types.Message):
         logging.error(f"Error generating analysis: {e}")
         analysis_text = "No analysis available (error)."
 
-    # 4) Combine everything into a final message
-    final_response = (
-        f"{report_text}\n"
-        f"<b>Analysis</b>\n{analysis_text}"
-    )
+    # 4) The analysis goes out as a follow-up message
+    analysis_message = f"<b>Analysis</b>\n{analysis_text}"
+
+    # 5) Store the user's request and the full report in one batched write
+    store_chat_turn(telegram_id, message.text, f"{report_text}\n{analysis_message}")
 
-    # 5) Store the user's request and your final response in Firestore chat
-    user_message = message.text
-    store_chat_message(telegram_id, "user", user_message)
-    store_chat_message(telegram_id, "assistant", final_response)
+    # 6) Send the analysis to the user
+    bot.send_message(message.chat.id, analysis_message, parse_mode="HTML")
 
-    # 6) Reply to the user
-    bot.reply_to(message, final_response, parse_mode="HTML")
 
+# One lock per user so concurrent turns from the same conversation can't
+# race on the history cache (both reading pre-state); different users still
+# run fully in parallel across the worker threads
+_user_turn_locks: Dict[str, threading.Lock] = {}
+_user_turn_locks_guard = threading.Lock()
+
+def _user_turn_lock(telegram_id: str) -> threading.Lock:
+    with _user_turn_locks_guard:
+        return _user_turn_locks.setdefault(telegram_id, threading.Lock())
 
 @bot.message_handler(func=lambda message: True)
 def handle_chat(message: types.Message):
@@ -333,126 +673,264 @@ def handle_chat(message: types.Message):
     try:
         telegram_id = str(message.from_user.id)
         user_message = message.text
+
+        with _user_turn_lock(telegram_id):
+            _handle_chat_turn(message, telegram_id, user_message)
+    except Exception as e:
+        logging.error(f"Error in chat handler: {e}")
+        bot.reply_to(message, "Sorry, I encountered an error while processing your message. Please try again later.")
+
+def _handle_chat_turn(message: types.Message, telegram_id: str, user_message: str):
+    # Kick off the history read in the pool while we fetch today's
+    # health data — the two Firestore reads are independent. 20 turns is
+    # plenty of LLM context and keeps reads and prompt tokens bounded.
+    history_future = _io_pool.submit(get_chat_history, telegram_id, 20)
+
+    # Get today's health data using the same function as /report
+    date_str = datetime.datetime.now().strftime("%Y-%m-%d")
+    daily_data = get_daily_health_data_from_firestore(telegram_id, date_str)
+    chat_history = history_future.result()
+    
+    # Format health data similar to /report handler
+    health_summary = []
+    
+    # Add sleep summary if available
+    if sleep_records := daily_data.get("sleep_records", []):
+        entry = sleep_records[0]
+        stage_summary = entry["score"]["stage_summary"]
+        slow_wave = stage_summary["total_slow_wave_sleep_time_milli"]
+        rem = stage_summary["total_rem_sleep_time_milli"]
+        health_summary.append(
+            f"Sleep - SWS: {millis_to_hhmm(slow_wave)}, "
+            f"REM: {millis_to_hhmm(rem)}"
+        )
         
-        # Get recent chat history
-        chat_history = get_chat_history(telegram_id)
-        
-        # Get today's health data using the same function as /report
-        date_str = datetime.datetime.now().strftime("%Y-%m-%d")
-        daily_data = get_daily_health_data_from_firestore(telegram_id, date_str)
+    # Add recovery if available
+    if recovery_records := daily_data.get("recovery_records", []):
+        score = recovery_records[0]["score"]["recovery_score"]
+        health_summary.append(f"Recovery Score: {score}")
         
-        # Format health data similar to /report handler
-        health_summary = []
+    # Add workout if available
+    if workout_records := daily_data.get("workout_records", []):
+        strain = workout_records[0]["score"]["strain"]
+        health_summary.append(f"Daily Strain: {strain}")
         
-        # Add sleep summary if available
-        if sleep_records := daily_data.get("sleep_records", []):
-            entry = sleep_records[0]
-            stage_summary = entry["score"]["stage_summary"]
-            slow_wave = stage_summary["total_slow_wave_sleep_time_milli"]
-            rem = stage_summary["total_rem_sleep_time_milli"]
-            health_summary.append(
-                f"Sleep - SWS: {millis_to_hhmm(slow_wave)}, "
-                f"REM: {millis_to_hhmm(rem)}"
-            )
-            
-        # Add recovery if available
-        if recovery_records := daily_data.get("recovery_records", []):
-            score = recovery_records[0]["score"]["recovery_score"]
-            health_summary.append(f"Recovery Score: {score}")
-            
-        # Add workout if available
-        if workout_records := daily_data.get("workout_records", []):
-            strain = workout_records[0]["score"]["strain"]
-            health_summary.append(f"Daily Strain: {strain}")
-            
-        health_data_str = "\n".join(health_summary) if health_summary else "No health data available"
-              
-        # Add context and system instructions to the prompt
-        prompt = SYSTEM_INSTRUCTIONS.format(
-                user_name=message.from_user.first_name,
-                health_data=health_data_str,
-                chat_history=chat_history[-100:] if chat_history else 'No history',
-                current_message=user_message
+    health_data_str = "\n".join(health_summary) if health_summary else "No health data available"
+          
+    # The persona lives on chat_model's system instruction; only the
+    # small per-turn context block is built here. The history is passed
+    # as native conversation turns rather than stringified into the
+    # prompt, so the model sees real roles and Gemini can reuse its
+    # server-side cache across turns
+    prompt = render_chat_context(
+            user_name=message.from_user.first_name,
+            health_data=health_data_str,
+            current_message=user_message
+        )
+
+    contents = [
+        {"role": "user" if msg["role"] == "user" else "model",
+         "parts": [msg["content"]]}
+        for msg in chat_history
+    ]
+    contents.append({"role": "user", "parts": [prompt]})
+
+    # Send a placeholder immediately, then stream Gemini's output into it
+    # so the user sees text at first-token latency instead of waiting for
+    # the full completion
+    placeholder = bot.reply_to(message, "…")
+    response = chat_model.generate_content(contents, stream=True)
+
+    full_text = ""
+    pending_chars = 0
+    last_edit = 0.0
+    for chunk in response:
+        chunk_text = chunk.text or ""
+        if not chunk_text:
+            continue
+        full_text += chunk_text
+        pending_chars += len(chunk_text)
+
+        # Throttle edits to stay under Telegram's ~1 edit/sec flood limit
+        if pending_chars >= 24 and time.monotonic() - last_edit >= 0.8:
+            try:
+                bot.edit_message_text(
+                    full_text,
+                    chat_id=message.chat.id,
+                    message_id=placeholder.message_id,
+                )
+                pending_chars = 0
+                last_edit = time.monotonic()
+            except Exception as edit_error:
+                logging.warning(f"Streaming edit failed: {edit_error}")
+
+    if full_text:
+        # Convert markdown to HTML for the final version of the message
+        formatted_response = convert_markdown_to_html(full_text)
+
+        # Store both messages in one batched write after getting the response
+        store_chat_turn(telegram_id, user_message, formatted_response)
+        try:
+            bot.edit_message_text(
+                formatted_response,
+                chat_id=message.chat.id,
+                message_id=placeholder.message_id,
+                parse_mode="HTML",
             )
-        
-        # Generate response from Gemini
-        response = model.generate_content(prompt)
-        
-        if response.text:
-            # Convert markdown to HTML before sending
-            formatted_response = convert_markdown_to_html(response.text)
-            
-            # Store both messages after getting the response
-            store_chat_message(telegram_id, "user", user_message)
-            store_chat_message(telegram_id, "assistant", formatted_response)
-            bot.reply_to(message, formatted_response)
-        else:
-            bot.reply_to(message, "I apologize, but I couldn't generate a response. Please try again.")
-            
-    except Exception as e:
-        logging.error(f"Error in chat handler: {e}")
-        bot.reply_to(message, "Sorry, I encountered an error while processing your message. Please try again later.")
+        except Exception as edit_error:
+            # The streamed text may already match the final text
+            logging.warning(f"Final edit failed: {edit_error}")
+    else:
+        bot.edit_message_text(
+            "I apologize, but I couldn't generate a response. Please try again.",
+            chat_id=message.chat.id,
+            message_id=placeholder.message_id,
+        )
 
 
 # (5) FASTAPI ROUTES
 
+# Recently seen update ids, so Telegram's retry of an already-accepted
+# delivery doesn't run the handlers (and charge Gemini) twice. Only touched
+# from the event loop, so no lock is needed; the deque evicts oldest-first.
+_seen_update_ids = set()
+_seen_update_order = deque()
+_SEEN_UPDATES_MAX = 4096
+
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
     """
     The Telegram webhook endpoint. All updates from Telegram come here.
+    Ack Telegram right away and hand the update to the worker queue so slow
+    handlers (Firestore + Gemini) can't trigger webhook retries.
     """
     try:
-        update = await request.json()
-        logging.info(f"Received webhook update: {update}")
-        bot.process_new_updates([telebot.types.Update.de_json(update)])
-        logging.info("Successfully processed webhook update")
+        # Parse the raw body once with orjson instead of request.json()'s
+        # decode-then-parse round
+        update = telebot.types.Update.de_json(orjson.loads(await request.body()))
+        if update.update_id in _seen_update_ids:
+            logging.info(f"Skipping duplicate webhook update: {update.update_id}")
+            return {"status": "ok"}
+        _seen_update_ids.add(update.update_id)
+        _seen_update_order.append(update.update_id)
+        if len(_seen_update_order) > _SEEN_UPDATES_MAX:
+            _seen_update_ids.discard(_seen_update_order.popleft())
+
+        logging.info(f"Received webhook update: {update.update_id}")
+        await update_queue.put(update)
     except Exception as e:
         logging.error(f"Telegram webhook error: {e}")
         return {"status": "error", "message": str(e)}
     return {"status": "ok"}
 
+# Pace outbound proactive sends under Telegram's ~30 msg/s bot-wide cap so
+# large fan-outs don't turn into 429 retry storms
+_SEND_INTERVAL = 1 / 30
+_send_pace_lock = asyncio.Lock()
+_last_send_at = 0.0
+
+async def send_message_paced(telegram_id: str, text: str) -> None:
+    global _last_send_at
+    async with _send_pace_lock:
+        wait = _SEND_INTERVAL - (time.monotonic() - _last_send_at)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        _last_send_at = time.monotonic()
+    await asyncio.to_thread(bot.send_message, telegram_id, text)
+
+def try_acquire_lease(lease_id: str, ttl_seconds: int) -> bool:
+    """
+    Acquire a short-lived lease document transactionally. Returns False when
+    another invocation still holds the lease, so overlapping Cloud Scheduler
+    ticks don't double the work (and double-message users).
+    """
+    lease_ref = db.collection("leases").document(lease_id)
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def attempt(tx):
+        snapshot = lease_ref.get(transaction=tx)
+        now = time.time()
+        if snapshot.exists and snapshot.to_dict().get("expires_at", 0) > now:
+            return False
+        tx.set(lease_ref, {"expires_at": now + ttl_seconds})
+        return True
+
+    return attempt(transaction)
+
 @app.post("/scheduled/check-in")
-async def scheduled_check_in(background_tasks: BackgroundTasks):
+async def scheduled_check_in():
     """Endpoint triggered by Cloud Scheduler every x hours to check users and send proactive messages if appropriate."""
     try:
-        # Get all users
-        users_ref = db.collection("users")
-        users_list = users_ref.stream()
+        # Skip entirely if a previous invocation is still running
+        if not await asyncio.to_thread(try_acquire_lease, "scheduled_check_in", 600):
+            logging.info("Scheduled check-in skipped: lease held by another run")
+            return {"status": "skipped", "message": "Previous check still running"}
 
         # Determine today's date string (or pick any date logic you like)
         today_str = datetime.datetime.utcnow().strftime("%Y-%m-%d")
 
-        for user_doc in users_list:
-            telegram_id = user_doc.id
+        # Two collection-group queries replace the per-user health-metrics
+        # and chat-history reads; they're independent, so run them in parallel
+        daily_data_by_user, _ = await asyncio.gather(
+            asyncio.to_thread(get_daily_health_data_for_all_users, today_str),
+            asyncio.to_thread(prefetch_recent_chat_histories),
+        )
+
+        # Bound how many users we process at once so one slow user doesn't
+        # stall the rest and Gemini isn't hit with unbounded concurrency
+        semaphore = asyncio.Semaphore(20)
 
+        async def process_user(user_doc):
+            telegram_id = user_doc.id
             user_data = user_doc.to_dict()
             if not user_data:
-                continue
-
-            # Retrieve recent chat history
-            chat_history = get_chat_history(telegram_id)
-            
-            # Get today's health data from Firestore subcollection
-            daily_data = get_daily_health_data_from_firestore(telegram_id, today_str)
-            
-            # Convert that raw daily_data into a short summary
-            health_summary = summarize_daily_health_data(daily_data)
-
-            # Pass user_data, chat_history, AND the health_summary
-            message = generate_proactive_message(user_data, chat_history, health_summary)
-            print(f"MESSAGE: {message}")
+                return
+
+            # Skip conversations with recent activity before touching their
+            # history or Gemini — the profile-level marker makes this a
+            # zero-RPC check for the (usually large) inactive majority
+            last_message_at = user_data.get("last_message_at")
+            if last_message_at is not None:
+                now = datetime.datetime.now(datetime.timezone.utc)
+                if now - last_message_at < timedelta(hours=4):
+                    return
+
+            async with semaphore:
+                # The Firestore/Gemini helpers are sync, so run each user's
+                # check in a worker thread and overlap the network waits
+                message = await asyncio.to_thread(
+                    check_in_user,
+                    telegram_id,
+                    user_data,
+                    today_str,
+                    daily_data_by_user.get(telegram_id, {}),
+                )
 
             if message:
-                # Send message in background to avoid timeout
-                background_tasks.add_task(bot.send_message, telegram_id, message)
-                # Store bot's message in chat history
-                background_tasks.add_task(
-                    store_chat_message, 
-                    telegram_id, 
-                    "assistant", 
-                    message
+                # Paced send keeps us under the bot-wide rate limit; the
+                # history write still overlaps across users via the gather
+                await send_message_paced(telegram_id, message)
+                await asyncio.to_thread(
+                    store_chat_message, telegram_id, "assistant", message
                 )
 
+        # Project only the field this path actually reads so we don't pull
+        # token blobs and the rest of the profile for every user, and page
+        # through the collection so memory stays bounded and the first page
+        # starts processing without waiting for a full-collection scan
+        page_size = 500
+        query = db.collection("users").select(["name", "tz_offset_minutes", "last_message_at"]) \
+                  .order_by("__name__").limit(page_size)
+        while True:
+            user_docs = await asyncio.to_thread(lambda q=query: list(q.stream()))
+            if not user_docs:
+                break
+            await asyncio.gather(*(process_user(user_doc) for user_doc in user_docs))
+            query = db.collection("users").select(["name", "tz_offset_minutes", "last_message_at"]) \
+                      .order_by("__name__") \
+                      .start_after(user_docs[-1]).limit(page_size)
+
         return {"status": "success", "message": "Proactive check completed"}
     except Exception as e:
         logging.error(f"Error in scheduled check: {e}")
@@ -469,20 +947,27 @@ async def scheduled_update_health_data():
         # Determine today's date string
         today_str = datetime.datetime.utcnow().strftime("%Y-%m-%d")
 
-        # Get all users
-        users_ref = db.collection("users")
-        users_list = users_ref.stream()
-
-        for user_doc in users_list:
-            telegram_id = user_doc.id
-            user_data = user_doc.to_dict()
+        # Bound concurrency so we overlap WHOOP round-trips without blowing
+        # through their per-app rate limit
+        semaphore = asyncio.Semaphore(16)
 
-            # Skip if the user has no tokens
-            if not user_data.get("whoop_access_token"):
-                continue
+        async def update_user(telegram_id: str):
+            async with semaphore:
+                await update_daily_health_data(telegram_id, date_str=today_str)
 
-            # Update today's data
-            update_daily_health_data(telegram_id, date_str=today_str)
+        # Let Firestore return only linked users instead of reading every
+        # document just to skip the unlinked ones
+        linked_users_query = (
+            db.collection("users")
+              .where("whoop_access_token", "!=", "")
+              .select(["whoop_access_token"])
+        )
+        users_list = await asyncio.to_thread(
+            lambda: list(linked_users_query.stream())
+        )
+        await asyncio.gather(*(
+            update_user(user_doc.id) for user_doc in users_list
+        ))
 
         return {"status": "success", "message": "Daily health data updates completed."}
     except Exception as e:
@@ -498,11 +983,25 @@ async def whoop_callback(request: Request):
     if not code or not state:
         return {"error": "Missing code or state in the WHOOP callback."}
 
-    oauth_state_doc = db.collection("oauth_states").document(state).get()
-    if not oauth_state_doc.exists:
+    # Read and delete the state atomically, so a replayed callback can't
+    # reuse it in the window between lookup and cleanup (and the separate
+    # delete RPC goes away)
+    state_ref = adb.collection("oauth_states").document(state)
+    transaction = adb.transaction()
+
+    @firestore.async_transactional
+    async def consume_state(tx):
+        snapshot = await state_ref.get(transaction=tx)
+        if not snapshot.exists:
+            return None
+        tx.delete(state_ref)
+        return snapshot.to_dict()
+
+    state_data = await consume_state(transaction)
+    if state_data is None:
         return {"error": "Invalid or expired state. Cannot link WHOOP account."}
 
-    telegram_id = oauth_state_doc.to_dict().get("telegram_id")
+    telegram_id = state_data.get("telegram_id")
     if not telegram_id:
         return {"error": "Could not determine Telegram user from state."}
 
@@ -518,23 +1017,24 @@ async def whoop_callback(request: Request):
     }
 
     try:
-        resp = requests.post(token_url, data=payload, timeout=10)
+        # Reuse the pooled async client so the token exchange doesn't block
+        # the event loop or pay a fresh TLS handshake
+        resp = await whoop_client.post(token_url, data=payload)
         resp.raise_for_status()
-        token_data = resp.json()
+        token_data = orjson.loads(resp.content)
         access_token = token_data.get("access_token")
         refresh_token = token_data.get("refresh_token")
 
         if not access_token:
             return {"error": "No access token returned from WHOOP."}
 
-        # Store tokens in Firestore
-        db.collection("users").document(telegram_id).set(
+        # The state doc was already consumed above, so only the tokens
+        # remain to be written
+        await adb.collection("users").document(telegram_id).set(
             {"whoop_access_token": access_token, "whoop_refresh_token": refresh_token},
             merge=True,
         )
-
-        # Clean up used state
-        db.collection("oauth_states").document(state).delete()
+        invalidate_user_cache(telegram_id)
 
         # Notify user
         bot.send_message(
@@ -591,6 +1091,106 @@ def summarize_daily_health_data(daily_data: dict) -> str:
 
     return " | ".join(summary_parts)
 
+# Obvious "don't message me" phrasings we can catch without an LLM.
+# Deliberately narrow: casual mentions ("busy day", "see you later") must
+# not read as opt-outs.
+_NEGATIVE_RE = re.compile(
+    r"\b(stop|leave me alone|don'?t (text|message) me)\b",
+    re.IGNORECASE,
+)
+
+def should_check_in(user_data: dict, chat_history: list, daily_data: dict) -> bool:
+    """
+    Cheap pre-LLM gate for the proactive check. Skips the Gemini call when
+    there is nothing new to talk about or when we'd just be spamming.
+    """
+    # Don't wake users up: server time is UTC, so shift by the user's stored
+    # offset (defaults to UTC when the profile has none) before gating
+    offset = timedelta(minutes=user_data.get("tz_offset_minutes") or 0)
+    local_hour = (datetime.datetime.utcnow() + offset).hour
+    if local_hour >= 22 or local_hour < 7:
+        return False
+
+    # Nothing to say to a user with no health data and no conversation yet
+    if not daily_data and not chat_history:
+        return False
+
+    # Respect an explicit opt-out in the user's recent messages without
+    # paying for a Gemini call to find it. Only the last day counts: an
+    # inactive user's window never changes, so an unbounded match would
+    # suppress their check-ins forever
+    optout_cutoff = datetime.datetime.now(datetime.timezone.utc) - timedelta(hours=24)
+    recent_user_text = " ".join(
+        m["content"]
+        for m in chat_history[-5:]
+        if m["role"] == "user" and m["timestamp"] >= optout_cutoff
+    )
+    if _NEGATIVE_RE.search(recent_user_text):
+        logging.info(
+            "Skipping check-in for %s: opt-out phrase in recent messages",
+            user_data.get("name", "unknown user"),
+        )
+        return False
+
+    # Don't pile a new proactive message onto an unanswered recent one.
+    # History timestamps are timezone-aware datetimes (Firestore returns
+    # them that way and the cache stores them that way), so compare directly.
+    if chat_history and chat_history[-1]["role"] == "assistant":
+        last_ts = chat_history[-1]["timestamp"]
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if now - last_ts < timedelta(hours=4):
+            return False
+
+    return True
+
+# Context each user was last proactively checked against, so unchanged
+# users don't re-trigger Gemini on every scheduler tick
+_checkin_cache: Dict[str, tuple] = {}
+_CHECKIN_CACHE_TTL = 1800  # seconds
+
+def check_in_user(
+    telegram_id: str,
+    user_data: dict,
+    date_str: str,
+    daily_data: Optional[dict] = None,
+) -> Optional[str]:
+    """
+    Run the full proactive check for one user: pull chat history and today's
+    health data, then ask Gemini whether/what to send. Returns the message
+    text, or None if nothing should be sent.
+    """
+    # Retrieve recent chat history; the proactive prompts only ever look at
+    # the last few messages, so don't read more than that
+    chat_history = get_chat_history(telegram_id, limit=5)
+
+    # Today's health data, unless the caller already prefetched it
+    if daily_data is None:
+        daily_data = get_daily_health_data_from_firestore(telegram_id, date_str)
+
+    # Skip the Gemini round-trip entirely when heuristics already say no
+    if not should_check_in(user_data, chat_history, daily_data):
+        return None
+
+    # Convert that raw daily_data into a short summary
+    health_summary = summarize_daily_health_data(daily_data)
+
+    # If nothing changed since the last tick, don't ask Gemini again
+    context_key = (
+        chat_history[-1]["timestamp"] if chat_history else None,
+        len(chat_history),
+        health_summary,
+    )
+    cached = _checkin_cache.get(telegram_id)
+    if cached and cached[0] == context_key \
+            and time.monotonic() - cached[1] < _CHECKIN_CACHE_TTL:
+        return None
+    _checkin_cache[telegram_id] = (context_key, time.monotonic())
+
+    # Pass user_data, chat_history, AND the health_summary
+    message = generate_proactive_message(user_data, chat_history, health_summary)
+    logging.debug("Proactive message for %s: %s", telegram_id, message)
+    return message
+
 def generate_proactive_message(
     user_data: dict, 
     chat_history: List[Dict], 
@@ -602,54 +1202,58 @@ def generate_proactive_message(
     # Safely get the user's name
     user_name = user_data.get('name', 'User')
 
-    # Build the system prompt using the summary we created
-    prompt = SYSTEM_INSTRUCTIONS.format(
+    # Only the small dynamic context goes in the prompt; the persona is
+    # attached to proactive_model as its system instruction.
+    prompt = render_proactive_context(
         user_name=user_name,
         health_data=health_summary or "No data",  # fallback
         chat_history=chat_history[-3:] if chat_history else "No history",
-        current_message=""
     )
 
     try:
-        response = model.generate_content(prompt)
+        response = proactive_model.generate_content(prompt)
         return response.text.strip() if response and response.text else None
     except Exception as e:
         logging.error(f"Error generating proactive message: {e}")
         return None
 
 
+# Bold markdown (**text**) — compiled once, applied in a single C-level pass
+_BOLD_RE = re.compile(r"\*\*(.+?)\*\*", re.DOTALL)
+
 def convert_markdown_to_html(text: str) -> str:
     """Convert markdown-style formatting to HTML tags."""
-    # Handle bold text (**text**)
-    parts = text.split('**')
-    for i in range(1, len(parts), 2):
-        if i < len(parts):
-            # Wrap odd-indexed parts with <b> tags
-            parts[i] = f'<b>{parts[i]}</b>'
-    return ''.join(parts)
+    # Escape first so stray <, > or & in model output can't break Telegram's
+    # HTML parse mode; the ** markers survive escaping, so the bold pass
+    # then runs on already-safe text
+    return _BOLD_RE.sub(r"<b>\1</b>", html.escape(text, quote=False))
 
 def create_oauth_state_for_user(telegram_id: str) -> str:
     """Generate a unique 'state' value and store it in Firestore."""
-    state_value = str(uuid.uuid4())
+    state_value = secrets.token_urlsafe(16)
+    # created_at feeds the Firestore TTL policy on this collection
+    # (02-infra/main.tf, oauth_states_ttl), so abandoned states get
+    # garbage-collected instead of accumulating
     db.collection("oauth_states").document(state_value).set(
-        {"telegram_id": telegram_id}
+        {"telegram_id": telegram_id, "created_at": firestore.SERVER_TIMESTAMP}
     )
     return state_value
 
-def fetch_whoop_data(telegram_id: str, data_type: str, start_date: str = None) -> dict:
+async def fetch_whoop_data(telegram_id: str, data_type: str, start_date: str = None) -> dict:
     """
     Fetch WHOOP data (sleep, recovery, workout) from the WHOOP API,
     refreshing the access token if needed.
     
     data_type: one of ["sleep", "recovery", "workout"]
     """
-    # 1) Get current user doc to retrieve access and refresh tokens
-    user_doc_ref = db.collection("users").document(telegram_id).get()
-    if not user_doc_ref.exists:
+    # 1) Get current user doc (cached) to retrieve access and refresh tokens.
+    # The sync Firestore client runs in a worker thread so this coroutine
+    # never blocks the event loop.
+    user_data = await asyncio.to_thread(get_user_data, telegram_id)
+    if user_data is None:
         logging.error(f"No user doc for {telegram_id}")
         return {}
-    
-    user_data = user_doc_ref.to_dict()
+
     access_token = user_data.get("whoop_access_token")
     refresh_token = user_data.get("whoop_refresh_token")
     
@@ -674,29 +1278,35 @@ def fetch_whoop_data(telegram_id: str, data_type: str, start_date: str = None) -
         params["start_date"] = start_date
 
     # 4) Attempt the API request
-    whoop_data_response = _call_whoop_api(access_token, endpoint, params)
+    whoop_data_response = await _call_whoop_api(access_token, endpoint, params)
 
     # 5) If we got a 401 or 403, refresh the token and retry once
     if not whoop_data_response.get("success"):
         if "Unauthorized or Token Expired" in whoop_data_response.get("error", ""):
             logging.info("Access token might be expired, attempting refresh...")
-            refreshed_tokens = refresh_whoop_token(refresh_token)
+            refreshed_tokens = await refresh_whoop_token(refresh_token)
             if refreshed_tokens:
                 new_access_token = refreshed_tokens.get("access_token")
                 new_refresh_token = refreshed_tokens.get("refresh_token")
 
-                # Store new tokens in Firestore
-                db.collection("users").document(telegram_id).set({
-                    "whoop_access_token": new_access_token,
-                    "whoop_refresh_token": new_refresh_token,
-                }, merge=True)
+                # Store new tokens in Firestore (off the event loop).
+                # update() suffices here — the user doc must already exist
+                # for us to hold a refresh token — and skips merge diffing.
+                await asyncio.to_thread(
+                    db.collection("users").document(telegram_id).update,
+                    {
+                        "whoop_access_token": new_access_token,
+                        "whoop_refresh_token": new_refresh_token,
+                    },
+                )
+                invalidate_user_cache(telegram_id)
 
                 # Retry the original request
-                whoop_data_response = _call_whoop_api(new_access_token, endpoint, params)
+                whoop_data_response = await _call_whoop_api(new_access_token, endpoint, params)
 
     return whoop_data_response
 
-def _call_whoop_api(access_token: str, endpoint: str, params: dict = None) -> dict:
+async def _call_whoop_api(access_token: str, endpoint: str, params: dict = None) -> dict:
     """
     Makes the actual GET request to WHOOP for a given endpoint.
     Returns a dict with 'success' = True/False to indicate any error states.
@@ -708,20 +1318,20 @@ def _call_whoop_api(access_token: str, endpoint: str, params: dict = None) -> di
         }
         url = f"https://api.prod.whoop.com/developer/v1/{endpoint}"
         params = params or {}
-        
-        response = requests.get(url, headers=headers, params=params, timeout=10)
-        
+
+        response = await whoop_client.get(url, headers=headers, params=params)
+
         if response.status_code in (401, 403):
             return {"success": False, "error": "Unauthorized or Token Expired"}
 
         response.raise_for_status()
-        return {"success": True, **response.json()}
+        return {"success": True, **orjson.loads(response.content)}
     except Exception as e:
         logging.error(f"Error fetching Whoop {endpoint} data: {e}")
         return {"success": False, "error": str(e)}
 
 
-def refresh_whoop_token(refresh_token: str) -> Optional[dict]:
+async def refresh_whoop_token(refresh_token: str) -> Optional[dict]:
     """
     Calls WHOOP's refresh token endpoint to get a new access token.
     Returns a dict with new tokens on success, or None on failure.
@@ -736,9 +1346,9 @@ def refresh_whoop_token(refresh_token: str) -> Optional[dict]:
     }
 
     try:
-        resp = requests.post(token_url, data=payload, timeout=10)
+        resp = await whoop_client.post(token_url, data=payload)
         resp.raise_for_status()
-        token_data = resp.json()
+        token_data = orjson.loads(resp.content)
         # Should contain "access_token" and "refresh_token"
         return token_data
     except Exception as e:
@@ -747,35 +1357,46 @@ def refresh_whoop_token(refresh_token: str) -> Optional[dict]:
 
 def millis_to_hhmm(milliseconds):
     """Convert milliseconds to HH:MM format."""
-    td = timedelta(milliseconds=milliseconds)
-    total_minutes = td.total_seconds() / 60
-    hours = int(total_minutes // 60)
-    minutes = int(total_minutes % 60)
+    # Clamp: malformed WHOOP payloads occasionally carry negative durations
+    hours, minutes = divmod(max(milliseconds, 0) // 60000, 60)
     return f"{hours:02d}:{minutes:02d}"
 
-def update_daily_health_data(telegram_id: str, date_str: str) -> None:
+# Record fields consumed downstream (summaries, report prompt)
+_RECORD_KEEP_KEYS = ("score", "start", "end")
+
+def _strip_records(records: Optional[list]) -> list:
+    """Drop WHOOP record fields that nothing downstream reads."""
+    return [
+        {key: record[key] for key in _RECORD_KEEP_KEYS if key in record}
+        for record in (records or [])
+    ]
+
+async def update_daily_health_data(telegram_id: str, date_str: str) -> None:
     """
-    Fetch WHOOP sleep, recovery, and workout data for the given user 
+    Fetch WHOOP sleep, recovery, and workout data for the given user
     (for a particular date), then store/update it in Firestore.
     """
-    # 1) Fetch all data types
-    sleep_data = fetch_whoop_data(telegram_id, data_type="sleep", start_date=date_str)
-    recovery_data = fetch_whoop_data(telegram_id, data_type="recovery", start_date=date_str)
-    workout_data = fetch_whoop_data(telegram_id, data_type="workout", start_date=date_str)
+    # 1) Fetch all data types concurrently — they're independent, so wall
+    # time is the slowest WHOOP round-trip instead of the sum of three
+    sleep_data, recovery_data, workout_data = await asyncio.gather(
+        fetch_whoop_data(telegram_id, data_type="sleep", start_date=date_str),
+        fetch_whoop_data(telegram_id, data_type="recovery", start_date=date_str),
+        fetch_whoop_data(telegram_id, data_type="workout", start_date=date_str),
+    )
 
     # Check success, but don't bail completely if one fails
     sleep_records = sleep_data.get("records") if sleep_data.get("success") else []
     recovery_records = recovery_data.get("records") if recovery_data.get("success") else []
     workout_records = workout_data.get("records") if workout_data.get("success") else []
 
-    # 2) Prepare data to store
-    # You can store raw records or parse them. 
-    # For an example, we'll just store them as-is plus a timestamp.
+    # 2) Prepare data to store, keeping only the fields the summaries and
+    # prompts actually read — raw WHOOP records are several KB each and
+    # Firestore bills every byte again on each read
     data_to_store = {
-        "sleep_records": sleep_records,
-        "recovery_records": recovery_records,
-        "workout_records": workout_records,
-        "timestamp": datetime.datetime.utcnow()
+        "sleep_records": _strip_records(sleep_records),
+        "recovery_records": _strip_records(recovery_records),
+        "workout_records": _strip_records(workout_records),
+        "timestamp": firestore.SERVER_TIMESTAMP
     }
 
     # 3) Firestore doc reference
@@ -786,8 +1407,10 @@ def update_daily_health_data(telegram_id: str, date_str: str) -> None:
           .document(date_str)  # e.g. "2025-01-10"
     )
     
-    # 4) Set/merge data
-    metrics_doc_ref.set(data_to_store, merge=True)
+    # 4) Set/merge data (off the event loop); drop the cached copy so the
+    # next chat turn sees the fresh metrics immediately
+    await asyncio.to_thread(metrics_doc_ref.set, data_to_store, merge=True)
+    invalidate_health_cache(telegram_id, date_str)
 
     logging.info(f"Updated daily health data for user={telegram_id}, date={date_str}")
 
@@ -795,15 +1418,6 @@ def update_daily_health_data(telegram_id: str, date_str: str) -> None:
 # (7) GUNICORN / UVICORN ENTRYPOINT
 
 if __name__ == "__main__":
-    if BOT_MODE == "polling":
-        # First, explicitly remove any webhook
-        bot.remove_webhook()
-        logging.info("Removed webhook for polling mode")
-        
-        # Then start bot polling in a separate thread
-        polling_thread = threading.Thread(target=bot.infinity_polling)
-        polling_thread.start()
-        logging.info("Started bot polling")
-
-    # Start the FastAPI server
+    # Polling mode (when enabled) is started by the lifespan on the same
+    # event loop, so the entrypoint is identical for both modes
     uvicorn.run(app, host="127.0.0.1", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
@@ -7,18 +7,20 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 bot = telebot.TeleBot(TELEGRAM_TOKEN, parse_mode="HTML")
 
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-exp-1206")
-
 SYSTEM_PROMPT = "You are a helpful Telegram bot assistant. Provide clear and concise responses."
 
+genai.configure(api_key=GEMINI_API_KEY)
+# Passing the static prompt as system_instruction keeps the request prefix
+# identical across users, so Gemini's prompt cache can reuse it; only the
+# user's text goes over per call.
+model = genai.GenerativeModel("gemini-exp-1206", system_instruction=SYSTEM_PROMPT)
+
 @bot.message_handler(func=lambda message: True)
 def handle_chat(message):
     user_text = message.text
-    full_prompt = f"{SYSTEM_PROMPT}\n\nUser: {user_text}"
 
     try:
-        response = model.generate_content(full_prompt)
+        response = model.generate_content(user_text)
 
         if response.text:
             bot.reply_to(message, response.text)
